@@ -13,13 +13,18 @@ This script provides a GUI for controlling the flow rate of fluid out of a press
 import serial
 import os
 import sys
+import time
 import numpy as np
 from datetime import datetime
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QSlider, QPushButton, QVBoxLayout, QWidget, QSizePolicy, QSpinBox, QHBoxLayout
-from PyQt5.QtCore import QTimer, QRunnable, QThreadPool, Qt
-from simple_pid import PID
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from PyQt5.QtCore import QTimer, QThread, QObject, QSignalBlocker, pyqtSignal, Qt
+import pyqtgraph as pg
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to the plain Python function.
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # Constants
 MIN_FLOW_RATE = 0
@@ -34,19 +39,89 @@ INITIAL_POSITION = 0  # Initial valve position
 VALVE_POSITIONS = 400  # Total valve positions
 WEIGHT_CALIBRATION_FACTOR = 9  # Weight calibration factor (in g/s)
 WEIGHT_DATA_DIR = "weight_data_files"  # Directory for weight data files
+FLOW_RATE_EPS = 1e-3  # Deadband (in mL/s) below which the PID is not re-run
+FLUSH_INTERVAL = 60  # Number of samples between flushes of the weight data to disk
+PLOT_WINDOW = 600  # Number of most recent samples shown in the plots
+INITIAL_BUFFER_SIZE = 1024  # Initial capacity of the in-memory weight buffer
+DTYPE = np.dtype('<f4')  # float32 is ample for a 0.1 g scale and halves memory traffic
+
+
+@njit(cache=True, fastmath=True)
+def pid_step(error, last_error, integral, kp, ki, kd, dt, out_min, out_max):
+    """
+    Perform one PID step and return (output, integral, error).
+
+    The integral is not accumulated while the output is clamped (anti-windup).
+    """
+    integral += ki * error * dt
+    derivative = kd * (error - last_error) / dt if dt > 0.0 else 0.0
+    output = kp * error + integral + derivative
+    if output < out_min:
+        output = out_min
+        integral -= ki * error * dt
+    elif output > out_max:
+        output = out_max
+        integral -= ki * error * dt
+    return output, integral, error
+
+
+class WeightLogger(QObject):
+    """
+    Periodically flushes the weight data to disk on its own thread, so a
+    disk stall never blocks the Qt event loop.
+    """
+    def __init__(self, controller):
+        super().__init__()
+        self._controller = controller
+        self._count = 0
+
+    def append(self, weight):
+        """
+        Count a new sample and flush the weight data every FLUSH_INTERVAL samples.
+        """
+        self._count += 1
+        if self._count % FLUSH_INTERVAL == 0:
+            self._controller.flush()
 
 
-class FlowRateControl:
+class FlowRateControl(QObject):
     """
     The main class for controlling the flow rate of fluid.
     """
+    weight_written = pyqtSignal(float)
+
     def __init__(self, kp, ki, kd, setpoint=0):
+        super().__init__()
         self.create_data_dir()
         now = datetime.now()
         now_str = now.strftime("%Y-%m-%d_%H-%M-%S")
-        self.weight_file_path = os.path.join(WEIGHT_DATA_DIR, f"weight_data_{now_str}.npy")
-        self.pid = PID(kp, ki, kd, setpoint=setpoint)
-        self.thread_pool = QThreadPool()
+        self.weight_file_path = os.path.join(WEIGHT_DATA_DIR, f"weight_data_{now_str}.bin")
+        self._mm = np.memmap(self.weight_file_path, dtype=DTYPE, mode='w+', shape=(INITIAL_BUFFER_SIZE,))
+        self._flow = np.empty(INITIAL_BUFFER_SIZE, dtype=DTYPE)
+        self._n = 0
+        self.weight = 0.0  # float64 accumulator; the buffers store the float32 downcast
+        self._prev_weight = 0.0
+        self.kp, self.ki, self.kd = float(kp), float(ki), float(kd)
+        self.setpoint = float(setpoint)
+        self._integral = 0.0
+        self._last_error = 0.0
+        self._last_pv = None
+        self._last_sp = None
+        self._last_t = time.monotonic()
+        self._valve_position = INITIAL_POSITION
+        # Warm the JIT so the first control tick doesn't pay the compile cost.
+        pid_step(0.0, 0.0, 0.0, self.kp, self.ki, self.kd, 1.0, 0.0, float(VALVE_POSITIONS))
+        self._cmd = bytearray(b'/1A0000R\r\n')
+        self._cmd_digits = slice(3, 7)
+        try:
+            self._ser = serial.Serial(SERIAL_PORT, SERIAL_BAUDRATE, timeout=0, write_timeout=0)
+        except serial.SerialException:
+            self._ser = None  # Hardware not connected; valve commands are dropped.
+        self._log_thread = QThread()
+        self._logger = WeightLogger(self)
+        self._logger.moveToThread(self._log_thread)
+        self.weight_written.connect(self._logger.append, Qt.QueuedConnection)
+        self._log_thread.start()
 
     def create_data_dir(self):
         """
@@ -54,61 +129,93 @@ class FlowRateControl:
         """
         os.makedirs(WEIGHT_DATA_DIR, exist_ok=True)
 
-    def update_flow_rate_setpoint(self, flow_rate):
+    def write_weight_data(self, flow_rate):
         """
-        Update PID setpoint based on user input.
+        Increase the weight artificially based on the flow rate, keep it in memory
+        and append it to the weight data file.
         """
-        self.pid.setpoint = flow_rate
+        self._prev_weight = self.weight
+        self.weight += flow_rate
+        if self._n == self._mm.size:
+            self._mm.flush()
+            self._mm = np.memmap(self.weight_file_path, dtype=DTYPE, mode='r+', shape=(self._mm.size * 2,))
+            self._flow = np.resize(self._flow, self._flow.size * 2)
+        self._mm[self._n] = self.weight
+        self._flow[self._n] = self.weight - self._mm[self._n - 1] if self._n else 0.0
+        self._n += 1
+        self.weight_written.emit(self.weight)
 
-    def write_weight_data(self, flow_rate):
+    def read_weight_data(self):
         """
-        Increase the weight artificially based on the flow rate and write to a numpy file.
+        Return a view of the last PLOT_WINDOW weight samples (no copy).
         """
-        try:
-            current_data = np.load(self.weight_file_path)
-        except FileNotFoundError:
-            current_data = np.array([])
-        self.weight = current_data[-1] + flow_rate if current_data.size else flow_rate
-        current_data = np.append(current_data, self.weight)
-        np.save(self.weight_file_path, current_data)
+        return self._mm[max(0, self._n - PLOT_WINDOW):self._n]
 
-    def read_weight_data(self):
+    def read_flow_rate_data(self):
         """
-        Load weight data from the current weight file.
+        Return a view of the last PLOT_WINDOW flow rate samples (no copy).
         """
-        try:
-            weight_data = np.load(self.weight_file_path)
-        except FileNotFoundError:
-            weight_data = np.array([0,0])
-        return weight_data
+        return self._flow[max(1, self._n - PLOT_WINDOW):self._n]
 
-    def calculate_flow_rate(self, weight_data):
+    def calculate_flow_rate(self):
         """
-        Calculate the flow rate based on the change in weight.
+        Calculate the flow rate based on the change in weight, at full precision.
         """
-        return weight_data[-1] - weight_data[-2] if len(weight_data) >= 2 else 0
+        return self.weight - self._prev_weight if self._n >= 2 else 0
 
     def update_data(self):
         """
         Update data every second. Triggered by QTimer.
         """
-        weight_data = self.read_weight_data()
-        current_flow_rate = self.calculate_flow_rate(weight_data)
-        valve_position = int(self.pid(current_flow_rate))
-        valve_position = max(0, min(VALVE_POSITIONS, valve_position))
-        worker = Worker(self.set_valve_position, valve_position)
-        self.thread_pool.start(worker)
-        self.write_weight_data(valve_position/WEIGHT_CALIBRATION_FACTOR)
-        return current_flow_rate, valve_position
+        current_flow_rate = self.calculate_flow_rate()
+        setpoint = self.setpoint
+        now = time.monotonic()
+        dt = now - self._last_t
+        self._last_t = now
+        unchanged = (self._last_pv is not None
+                     and abs(current_flow_rate - self._last_pv) < FLOW_RATE_EPS
+                     and abs(setpoint - current_flow_rate) < FLOW_RATE_EPS
+                     and setpoint == self._last_sp)
+        if not unchanged:
+            output, self._integral, self._last_error = pid_step(
+                setpoint - float(current_flow_rate), self._last_error, self._integral,
+                self.kp, self.ki, self.kd, dt, 0.0, float(VALVE_POSITIONS))
+            valve_position = int(output)
+            self.set_valve_position(valve_position)
+            self._valve_position = valve_position
+        self._last_pv = current_flow_rate
+        self._last_sp = setpoint
+        self.write_weight_data(self._valve_position/WEIGHT_CALIBRATION_FACTOR)
+        return (current_flow_rate, self._valve_position,
+                self.read_weight_data(), self.read_flow_rate_data())
 
     def set_valve_position(self, position):
         """
         Set valve position via serial connection.
         """
-        command = f"/1A{position}R\r\n"
-        print(command)
-        # Uncomment the line below when connected to the hardware.
-        # self.serial_conn.write(command.encode())
+        if self._ser is not None:
+            self._cmd[self._cmd_digits] = b'%04d' % position
+            try:
+                self._ser.write(self._cmd)
+            except serial.SerialException:
+                self._ser = None  # Port lost mid-session; drop further commands.
+
+    def flush(self):
+        """
+        Flush the weight data to disk.
+        """
+        self._mm.flush()
+
+    def close(self):
+        """
+        Stop the logger thread, flush the weight data to disk and record the
+        number of samples written.
+        """
+        self._log_thread.quit()
+        self._log_thread.wait()
+        self.flush()
+        with open(self.weight_file_path + ".len", 'w') as fh:
+            fh.write(str(self._n))
 
 
 class FlowRateUI(QMainWindow):
@@ -122,7 +229,8 @@ class FlowRateUI(QMainWindow):
         self.setWindowTitle("Flow Rate Control")
         self.initUI()
 
-        self.timer = QTimer()
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
         self.timer.timeout.connect(self.update_data)
         self.timer.start(UPDATE_RATE_MS)
 
@@ -150,8 +258,8 @@ class FlowRateUI(QMainWindow):
         self.flow_rate_input.setMaximum(MAX_FLOW_RATE)
         control_layout.addWidget(self.flow_rate_input)
 
-        self.flow_rate_slider.valueChanged.connect(self.flow_rate_input.setValue)
-        self.flow_rate_input.valueChanged.connect(self.flow_rate_slider.setValue)
+        self.flow_rate_slider.valueChanged.connect(self._slider_to_spin)
+        self.flow_rate_input.valueChanged.connect(self._spin_to_slider)
 
         self.flow_rate_slider.setValue(INITIAL_POSITION)
 
@@ -160,28 +268,61 @@ class FlowRateUI(QMainWindow):
 
         self.current_flow_rate_label = QLabel("Current Flow Rate (mL/s): 0")
         control_layout.addWidget(self.current_flow_rate_label)
+        self._flow_rate_fmt = "Current Flow Rate (mL/s): %.2f"
+        self._last_shown_flow_rate = None
 
         self.valve_position_label = QLabel("Valve Position:")
         control_layout.addWidget(self.valve_position_label)
+        self.valve_position_value = QLabel("0")
+        control_layout.addWidget(self.valve_position_value)
+        self._last_shown_valve_position = None
 
         self.set_flow_rate_button.clicked.connect(self.update_flow_rate_setpoint)
 
         layout.addLayout(control_layout)
 
-        self.figure = plt.figure()
-        self.canvas = FigureCanvas(self.figure)
-        self.canvas.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        layout.addWidget(self.canvas)
+        # Create the plot widgets and curves once; plot_data only updates their data.
+        plot_layout = QVBoxLayout()
+
+        self.flow_rate_plot = pg.PlotWidget(title="Flow Rate Over Time")
+        self.flow_rate_plot.setLabel('bottom', "Time (s)")
+        self.flow_rate_plot.setLabel('left', "Flow Rate (mL/s)")
+        self.flow_rate_plot.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.flow_rate_curve = self.flow_rate_plot.plot(pen='y')
+        plot_layout.addWidget(self.flow_rate_plot)
+
+        self.weight_plot = pg.PlotWidget(title="Weight Over Time")
+        self.weight_plot.setLabel('bottom', "Time (s)")
+        self.weight_plot.setLabel('left', "Weight (g)")
+        self.weight_plot.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.weight_curve = self.weight_plot.plot(pen='c')
+        plot_layout.addWidget(self.weight_plot)
+
+        layout.addLayout(plot_layout)
 
         central_widget.setLayout(layout)
 
+    def _slider_to_spin(self, value):
+        """
+        Mirror the slider value into the spin box without re-emitting its signal.
+        """
+        blocker = QSignalBlocker(self.flow_rate_input)
+        self.flow_rate_input.setValue(value)
+
+    def _spin_to_slider(self, value):
+        """
+        Mirror the spin box value into the slider without re-emitting its signal.
+        """
+        blocker = QSignalBlocker(self.flow_rate_slider)
+        self.flow_rate_slider.setValue(value)
+
     def update_flow_rate_setpoint(self):
         """
         Update PID setpoint based on user input.
         """
         try:
             flow_rate = float(self.flow_rate_input.text())
-            self.controller.pid.setpoint = flow_rate
+            self.controller.setpoint = flow_rate
         except ValueError:
             print("Invalid input for flow rate. Please enter a valid number.")
 
@@ -189,54 +330,32 @@ class FlowRateUI(QMainWindow):
         """
         Update data every second. Triggered by QTimer.
         """
-        current_flow_rate, valve_position = self.controller.update_data()
+        current_flow_rate, valve_position, weight_data, flow_rate_data = self.controller.update_data()
 
-        self.current_flow_rate_label.setText(f"Current Flow Rate (mL/s): {current_flow_rate:.2f}")
-        self.valve_position_label.setText(f"Valve Position: {valve_position}")
+        if (self._last_shown_flow_rate is None
+                or abs(current_flow_rate - self._last_shown_flow_rate) > 0.005):
+            self.current_flow_rate_label.setText(self._flow_rate_fmt % current_flow_rate)
+            self._last_shown_flow_rate = current_flow_rate
+        if valve_position != self._last_shown_valve_position:
+            self.valve_position_value.setNum(valve_position)
+            self._last_shown_valve_position = valve_position
 
-        self.plot_data()
+        self.plot_data(weight_data, flow_rate_data)
 
-    def plot_data(self):
+    def plot_data(self, weight_data, flow_rate_data):
         """
-        Plot flow rate data and weight data.
+        Update the flow rate and weight plots with the given data.
         """
-        self.figure.clear()
-
-        ax1 = self.figure.add_subplot(211)
-        ax2 = self.figure.add_subplot(212)
-
-        weight_data = self.controller.read_weight_data()
-        flow_rate_data = np.diff(weight_data)
-
-        ax1.plot(flow_rate_data)
-        ax1.set_title("Flow Rate Over Time")
-        ax1.set_xlabel("Time (s)")
-        ax1.set_ylabel("Flow Rate (mL/s)")
-
-        ax2.plot(weight_data)
-        ax2.set_title("Weight Over Time")
-        ax2.set_xlabel("Time (s)")
-        ax2.set_ylabel("Weight (g)")
-
-        self.canvas.draw()
-
-
-class Worker(QRunnable):
-    """
-    Worker thread for non-blocking operations.
-    """
-    def __init__(self, fn, *args, **kwargs):
-        super(Worker, self).__init__()
-
-        self.fn = fn
-        self.args = args
-        self.kwargs = kwargs
+        self.flow_rate_curve.setData(flow_rate_data)
+        self.weight_curve.setData(weight_data)
 
-    def run(self):
+    def closeEvent(self, event):
         """
-        Run the specified function with given arguments.
+        Stop the update timer and flush the weight data before closing.
         """
-        self.fn(*self.args, **self.kwargs)
+        self.timer.stop()
+        self.controller.close()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":